@@ -194,7 +194,7 @@ class ActionQueue(NamedTuple):
             padding = jax.tree_map(lambda x: x[None].repeat(pad_size), UnitAction.do_nothing())
             data = jux.tree_util.concat_in_leaf([data, padding], axis=-1)
         chex.assert_shape(data[0], (max_queue_size, ))
-        return cls(data, jnp.int8(0), n_actions, n_actions)
+        return cls(data, jnp.int8(0), n_actions % max_queue_size, n_actions)  # rear wraps to 0 if full
 
     def to_lux(self) -> List[LuxAction]:
         data = np.array(self._get_sorted_data())
@@ -233,12 +233,7 @@ class ActionQueue(NamedTuple):
             count = self.count + 1
             return ActionQueue(data, self.front, rear, count)
 
-        return jax.lax.cond(
-            self.is_full(),
-            lambda _: self,
-            _push,
-            action,
-        )
+        return jux.tree_util.tree_where(self.is_full(), self, _push(action))
 
     def push_front(self, action: UnitAction) -> "ActionQueue":
         """Push an action into the front of the queue. There is no way to thrown an error in jitted function. It is user's responsibility to check if the queue is full.
@@ -262,20 +257,15 @@ class ActionQueue(NamedTuple):
             count = self.count + 1
             return ActionQueue(data, front, self.rear, count)
 
-        return jax.lax.cond(
-            self.is_full(),
-            lambda _: self,
-            _push,
-            action,
-        )
+        return jux.tree_util.tree_where(self.is_full(), self, _push(action))
 
     def pop(self) -> Tuple[UnitAction, "ActionQueue"]:
-        return jax.lax.cond(
+        return jux.tree_util.tree_where(
             self.is_empty(),
             # if empty, return empty action and self.
-            lambda self: (UnitAction(), self),
+            (UnitAction(), self),
             # else, return the front action and updated queue.
-            lambda self: (
+            (
                 self.peek(),
                 ActionQueue(
                     data=self.data,
@@ -284,7 +274,6 @@ class ActionQueue(NamedTuple):
                     count=self.count - 1,
                 ),
             ),
-            self,
         )
 
     def peek(self) -> UnitAction:
@@ -94,6 +94,14 @@ class State(NamedTuple):
     def UNIT_ACTION_QUEUE_SIZE(self):
         return self.units.action_queue.capacity
 
+    def _env_cfg_with_static_queue_size(self) -> EnvConfig:
+        '''
+        Under jit, all fields of self.env_cfg are traced. Replace UNIT_ACTION_QUEUE_SIZE
+        with the python int given by the shape of the units' action queues, so that
+        Unit.new and Unit.empty build queues of a static, compile-time known size.
+        '''
+        return self.env_cfg._replace(UNIT_ACTION_QUEUE_SIZE=self.UNIT_ACTION_QUEUE_SIZE)
+
     @property
     def MAX_GLOBAL_ID(self):
         return self.unit_id2idx.shape[-2]
@@ -196,12 +204,10 @@ class State(NamedTuple):
 
             # convert units
             def convert_units(lux_units: LuxUnit) -> Tuple[Unit, Array]:
-                units: Tuple[List[Unit], List[Unit]] = (
-                    [Unit.from_lux(unit, env_cfg) for unit in lux_units['player_0'].values()],
-                    [Unit.from_lux(unit, env_cfg) for unit in lux_units['player_1'].values()],
+                units: Tuple[Unit, Unit] = (  # sorted by unit_id
+                    Unit.batch_from_lux(sorted(lux_units['player_0'].values(), key=Unit.id_from_lux), env_cfg),
+                    Unit.batch_from_lux(sorted(lux_units['player_1'].values(), key=Unit.id_from_lux), env_cfg),
                 )
-                units[0].sort(key=lambda unit: unit.unit_id)  # sort
-                units[1].sort(key=lambda unit: unit.unit_id)
                 n_units = [
                     len(lux_units['player_0']),
                     len(lux_units['player_1']),
@@ -214,10 +220,8 @@ class State(NamedTuple):
                     jax.tree_util.tree_map(lambda x: x.repeat(buf_cfg.MAX_N_UNITS - n_units[1], axis=0), empty_unit),
                 )
                 units: Unit = jux.tree_util.batch_into_leaf([  # batch into leaf
-                    jux.tree_util.concat_in_leaf([jux.tree_util.batch_into_leaf(units[0]), padding_units[0]])
-                    if n_units[0] > 0 else padding_units[0],
-                    jux.tree_util.concat_in_leaf([jux.tree_util.batch_into_leaf(units[1]), padding_units[1]])
-                    if n_units[1] > 0 else padding_units[1],
+                    jux.tree_util.concat_in_leaf([units[0], padding_units[0]]),
+                    jux.tree_util.concat_in_leaf([units[1], padding_units[1]]),
                 ])
                 n_units = jnp.array(n_units, dtype=Unit.id_dtype())
                 return units, n_units
@@ -369,8 +373,8 @@ class State(NamedTuple):
 
         # convert units
         def _to_lux_units(units: Unit, n_unit: int) -> Dict[str, LuxUnit]:
-            units: List[Unit] = jux.tree_util.batch_out_of_leaf(units)[:n_unit]
-            units: List[LuxUnit] = [u.to_lux(lux_teams, lux_env_cfg) for u in units]
+            units: Unit = jax.tree_map(lambda x: x[:int(n_unit)], units)
+            units: List[LuxUnit] = Unit.batch_to_lux(units, lux_teams, lux_env_cfg)
             return {u.unit_id: u for u in units}
 
         lux_units = jux.tree_util.batch_out_of_leaf(self.units)
@@ -664,11 +668,8 @@ class State(NamedTuple):
         failed_players = failed_players | failed_action
 
         # update units action queue
-        action_queue_power_cost = jnp.array(
-            [unit_cfg.ACTION_QUEUE_POWER_COST for unit_cfg in self.env_cfg.ROBOTS],
-            dtype=Unit.__annotations__['power'],
-        )
-        update_power_req = action_queue_power_cost[self.units.unit_type]
+        update_power_req = self.units.get_cfg("ACTION_QUEUE_POWER_COST", self.env_cfg.ROBOTS) \
+                                     .astype(Unit.__annotations__['power'])
         chex.assert_shape(update_power_req, (2, self.MAX_N_UNITS))
         update_queue = actions.unit_action_queue_update & unit_mask & (update_power_req <= self.units.power)
         new_power = jnp.where(update_queue, self.units.power - update_power_req, self.units.power)
@@ -681,7 +682,11 @@ class State(NamedTuple):
             ),
             count=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.count),
             front=jnp.where(update_queue, 0, self.units.action_queue.front),
-            rear=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.rear),
+            rear=jnp.where(
+                update_queue,
+                actions.unit_action_queue_count % self.UNIT_ACTION_QUEUE_SIZE,
+                self.units.action_queue.rear,
+            ),
         )
         new_self: State = self._replace(units=self.units._replace(
             power=new_power,
@@ -743,7 +748,7 @@ class State(NamedTuple):
             action_info['valid_transfer'] | \
             action_info['valid_pickup']
         )
-        units = jax.vmap(jax.vmap(Unit.repeat_action))(self.units, success)
+        units = self.units.repeat_action(success)
         self = self._replace(units=units)
 
         # destroy dead units
@@ -781,14 +786,13 @@ class State(NamedTuple):
             new_units = new_units._replace(power=new_units.power * self.unit_mask)
             return new_units
 
-        self = self._replace(units=jax.lax.cond(
+        self = self._replace(units=jux.tree_util.tree_where(
             is_day(self.env_cfg, real_env_steps),
-            _gain_power,
-            lambda self: self.units,
-            self,
+            _gain_power(self),
+            self.units,
         ))
         '''
-        # this if statement is same as above jax.lax.cond
+        # this if statement is same as above jux.tree_util.tree_where
         if is_day(self.env_cfg, real_env_steps):
             new_units = self.units.gain_power(weather_cfg["power_gain_factor"])
             new_units = new_units._replace(power=new_units.power * self.unit_mask)
@@ -1026,7 +1030,8 @@ class State(NamedTuple):
         new_rubble = new_rubble.at[x, y].add(jnp.where(dig_lichen & (new_lichen[x, y] == 0), dig_rubble_removed, 0))
 
         # resources
-        add_resource = jax.vmap(Unit.add_resource, in_axes=(0, None, 0, None))
+        # dig gains are never negative, so the unchecked version is enough.
+        add_resource = jax.vmap(Unit._add_resource_unchecked, in_axes=(0, None, 0, None))
         add_resource = jax.vmap(add_resource, in_axes=(0, None, 0, None))
         dig_resource_gain = units.get_cfg("DIG_RESOURCE_GAIN", self.env_cfg.ROBOTS).astype(UnitCargo.dtype())
 
@@ -1123,8 +1128,7 @@ class State(NamedTuple):
             jnp.array([0, 1]),  # team_id
             is_build_heavy,  # unit_type
             unit_id,  # unit_id
-            # replace UNIT_ACTION_QUEUE_SIZE with a concrete value to make it JIT-able
-            self.env_cfg._replace(UNIT_ACTION_QUEUE_SIZE=self.UNIT_ACTION_QUEUE_SIZE),  # env_cfg
+            self._env_cfg_with_static_queue_size(),  # env_cfg
         )
         created_units = created_units._replace(pos=self.factories.pos)
 
@@ -1194,8 +1198,8 @@ class State(NamedTuple):
         # 2. resolve unit collision
         # classify units into groups
         unit_mask = self.unit_mask
-        light = (units.unit_type == UnitType.LIGHT) & unit_mask  # bool[2, U]
-        heavy = (units.unit_type == UnitType.HEAVY) & unit_mask  # bool[2, U]
+        light = ~units.is_heavy() & unit_mask  # bool[2, U]
+        heavy = units.is_heavy() & unit_mask  # bool[2, U]
         moving = is_moving & unit_mask
         still = (~is_moving) & unit_mask  # bool[2, U]
         chex.assert_shape(light, (2, self.MAX_N_UNITS))  # bool[2, U]
@@ -1344,8 +1348,7 @@ class State(NamedTuple):
 
         empty_unit = jax.tree_map(
             lambda x: jnp.array(x)[None, None],
-            # replace UNIT_ACTION_QUEUE_SIZE with a concrete value to make it JIT-able
-            Unit.empty(self.env_cfg._replace(UNIT_ACTION_QUEUE_SIZE=self.UNIT_ACTION_QUEUE_SIZE)),
+            Unit.empty(self._env_cfg_with_static_queue_size()),
         )
 
         units = jux.tree_util.tree_where(dead, empty_unit, units)
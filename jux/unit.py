@@ -1,14 +1,18 @@
+import functools
 from enum import IntEnum
-from typing import Dict, NamedTuple, Tuple, Union
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Union
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 from jax import Array, lax
+from luxai_s2.actions import format_action_vec
 from luxai_s2.config import EnvConfig as LuxEnvConfig
 from luxai_s2.team import Team as LuxTeam
 from luxai_s2.unit import Unit as LuxUnit
 from luxai_s2.unit import UnitType as LuxUnitType
 
+import jux.tree_util
 from jux.actions import ActionQueue, UnitAction
 from jux.config import EnvConfig, UnitConfig
 from jux.map.position import Position
@@ -22,24 +26,49 @@ class UnitType(IntEnum):
 
     @classmethod
     def from_lux(cls, lux_unit_type: LuxUnitType) -> "UnitType":
-        if lux_unit_type == LuxUnitType.LIGHT:
-            return cls.LIGHT
-        elif lux_unit_type == LuxUnitType.HEAVY:
-            return cls.HEAVY
-        else:
-            raise ValueError(f"Unknown unit type {lux_unit_type}")
+        try:
+            return _FROM_LUX_UNIT_TYPE[lux_unit_type]
+        except KeyError:
+            raise ValueError(f"Unknown unit type {lux_unit_type}") from None
 
     def to_lux(self) -> LuxUnitType:
-        if self == self.LIGHT:
-            return LuxUnitType.LIGHT
-        elif self == self.HEAVY:
-            return LuxUnitType.HEAVY
-        else:
-            raise ValueError(f"Unknown unit type {self}")
+        try:
+            return _TO_LUX_UNIT_TYPE[self]
+        except KeyError:
+            raise ValueError(f"Unknown unit type {self}") from None
+
+
+_FROM_LUX_UNIT_TYPE = {
+    LuxUnitType.LIGHT: UnitType.LIGHT,
+    LuxUnitType.HEAVY: UnitType.HEAVY,
+}
+_TO_LUX_UNIT_TYPE = {
+    UnitType.LIGHT: LuxUnitType.LIGHT,
+    UnitType.HEAVY: LuxUnitType.HEAVY,
+}
+
+# Plain int copy of UnitType.HEAVY for the hot path. Comparing a traced
+# unit_type with it is a pure XLA eq op without any IntEnum lookup, and a
+# python int keeps the comparison in unit_type's own dtype.
+_HEAVY = int(UnitType.HEAVY)
+_LIGHT_UNIT_TYPE = jnp.int8(UnitType.LIGHT)
+
+
+@functools.lru_cache(maxsize=8)
+def _empty_action_queue_on_host(size: int) -> ActionQueue:
+    # Cache numpy arrays, not device arrays, which would stay on whichever device
+    # built them first. Evaluate eagerly, so no tracer gets cached under jit/vmap.
+    with jax.ensure_compile_time_eval():
+        return jax.device_get(ActionQueue.empty(size))
+
+
+def _empty_action_queue(size: int) -> ActionQueue:
+    # moved to the current default device on every call
+    return jax.tree_map(jnp.asarray, _empty_action_queue_on_host(size))
 
 
 class Unit(NamedTuple):
-    unit_type: UnitType  # int8
+    unit_type: jnp.int8  # UnitType, never stored as a python IntEnum
     action_queue: ActionQueue  # ActionQueue[UNIT_ACTION_QUEUE_SIZE, 5]
     team_id: jnp.int8 = imax(jnp.int8)
     unit_id: jnp.int16 = imax(jnp.int16)
@@ -52,7 +81,18 @@ class Unit(NamedTuple):
     def id_dtype():
         return Unit.__annotations__['unit_id']
 
+    @staticmethod
+    def id_from_lux(lux_unit: LuxUnit) -> int:
+        '''Parse the integer id out of a Lux unit id like "unit_42".'''
+        return int(lux_unit.unit_id[len('unit_'):])
+
     def get_cfg(self, attr: str, unit_cfgs: Tuple[UnitConfig, UnitConfig]):
+        '''Look up a UnitConfig attribute by unit type.
+
+        Unit configs are stored only once in EnvConfig.ROBOTS, indexed by
+        UnitType, and never copied into units. This works for a single unit
+        as well as for batched units.
+        '''
         attr_values = jnp.array([
             getattr(unit_cfgs[0], attr),
             getattr(unit_cfgs[1], attr),
@@ -61,30 +101,31 @@ class Unit(NamedTuple):
 
     @staticmethod
     def new(team_id: int, unit_type: Union[UnitType, int], unit_id: int, env_cfg: EnvConfig):
-        unit = Unit(
-            unit_type=jnp.int8(unit_type),
+        unit_type = Unit.__annotations__['unit_type'](unit_type)
+        light_cfg, heavy_cfg = env_cfg.ROBOTS
+        init_power = jnp.where(unit_type == _HEAVY, heavy_cfg.INIT_POWER, light_cfg.INIT_POWER)
+        return Unit(
+            unit_type=unit_type,
             team_id=Unit.__annotations__['team_id'](team_id),
             unit_id=Unit.__annotations__['unit_id'](unit_id),
             pos=Position(),
             cargo=UnitCargo(),
-            action_queue=ActionQueue.empty(env_cfg.UNIT_ACTION_QUEUE_SIZE),
-            power=None,
+            action_queue=_empty_action_queue(int(env_cfg.UNIT_ACTION_QUEUE_SIZE)),
+            power=Unit.__annotations__['power'](init_power),
         )
-        init_power = unit.get_cfg('INIT_POWER', env_cfg.ROBOTS)
-        return unit._replace(power=Unit.__annotations__['power'](init_power))
 
     @classmethod
     def empty(cls, env_cfg: EnvConfig):
         return cls(
-            unit_type=jnp.int8(UnitType.LIGHT),
-            action_queue=ActionQueue.empty(env_cfg.UNIT_ACTION_QUEUE_SIZE),
+            unit_type=_LIGHT_UNIT_TYPE,
+            action_queue=_empty_action_queue(int(env_cfg.UNIT_ACTION_QUEUE_SIZE)),
         )
 
     @classmethod
     def from_lux(cls, lux_unit: LuxUnit, env_cfg: EnvConfig) -> "Unit":
-        unit_id = int(lux_unit.unit_id[len('unit_'):])
+        unit_id = Unit.id_from_lux(lux_unit)
         return Unit(
-            unit_type=jnp.int8(UnitType.from_lux(lux_unit.unit_type)),
+            unit_type=Unit.__annotations__['unit_type'](UnitType.from_lux(lux_unit.unit_type)),
             team_id=Unit.__annotations__['team_id'](lux_unit.team_id),
             unit_id=Unit.__annotations__['unit_id'](unit_id),
             pos=Position.from_lux(lux_unit.pos),
@@ -96,7 +137,7 @@ class Unit(NamedTuple):
     def to_lux(self, lux_teams: Dict[str, LuxTeam], lux_env_cfg: LuxEnvConfig) -> LuxUnit:
         lux_unit = LuxUnit(
             team=lux_teams[f'player_{int(self.team_id)}'],
-            unit_type=UnitType(self.unit_type).to_lux(),
+            unit_type=UnitType(int(self.unit_type)).to_lux(),
             unit_id=f"unit_{int(self.unit_id)}",
             env_cfg=lux_env_cfg,
         )
@@ -106,13 +147,98 @@ class Unit(NamedTuple):
         lux_unit.action_queue = self.action_queue.to_lux()
         return lux_unit
 
+    @classmethod
+    def batch_from_lux(cls, lux_units: Sequence[LuxUnit], env_cfg: EnvConfig) -> "Unit":
+        '''Convert a sequence of Lux units into a batched Unit[len(lux_units)].
+
+        All fields are first written into pre-allocated numpy arrays, and then
+        moved to device once per field, instead of creating device arrays for
+        every unit.
+        '''
+        n_units = len(lux_units)
+        queue_size = env_cfg.UNIT_ACTION_QUEUE_SIZE
+
+        unit_type = np.empty(n_units, dtype=Unit.__annotations__['unit_type'])
+        team_id = np.empty(n_units, dtype=Unit.__annotations__['team_id'])
+        unit_id = np.empty(n_units, dtype=Unit.__annotations__['unit_id'])
+        pos = np.empty((n_units, 2), dtype=Position.dtype())
+        stock = np.empty((n_units, 4), dtype=UnitCargo.dtype())
+        power = np.empty(n_units, dtype=Unit.__annotations__['power'])
+        n_actions = np.empty(n_units, dtype=ActionQueue.__annotations__['count'])
+        actions = np.empty((n_units, queue_size, len(UnitAction._fields)), dtype=np.int32)
+        actions[...] = np.array(UnitAction.do_nothing())  # padding
+
+        for i, lux_unit in enumerate(lux_units):
+            unit_type[i] = UnitType.from_lux(lux_unit.unit_type)
+            team_id[i] = lux_unit.team_id
+            unit_id[i] = Unit.id_from_lux(lux_unit)
+            pos[i] = lux_unit.pos.pos
+            stock[i] = (lux_unit.cargo.ice, lux_unit.cargo.ore, lux_unit.cargo.water, lux_unit.cargo.metal)
+            power[i] = lux_unit.power
+            n_actions[i] = len(lux_unit.action_queue)
+            assert n_actions[i] <= queue_size, \
+                f"{n_actions[i]} actions is too much for ActionQueue size {queue_size}"
+            for j, act in enumerate(lux_unit.action_queue):
+                code: np.ndarray = act.state_dict()
+                assert code.shape == (6, ), f"Invalid UnitAction action code: {code}"
+                actions[i, j] = code
+
+        data = UnitAction(*[
+            jnp.asarray(actions[..., k], dtype=UnitAction.__annotations__[field])
+            for k, field in enumerate(UnitAction._fields)
+        ])
+        n_actions = jnp.asarray(n_actions)
+        return cls(
+            unit_type=jnp.asarray(unit_type),
+            action_queue=ActionQueue(
+                data=data,
+                front=jnp.zeros_like(n_actions),
+                rear=n_actions % queue_size,
+                count=n_actions,
+            ),
+            team_id=jnp.asarray(team_id),
+            unit_id=jnp.asarray(unit_id),
+            pos=Position(jnp.asarray(pos)),
+            cargo=UnitCargo(jnp.asarray(stock)),
+            power=jnp.asarray(power),
+        )
+
+    @staticmethod
+    def batch_to_lux(units: "Unit", lux_teams: Dict[str, LuxTeam], lux_env_cfg: LuxEnvConfig) -> List[LuxUnit]:
+        '''Convert a batched Unit[U] into a list of U Lux units.
+
+        Each field is copied to host once, and Lux units are built from numpy
+        arrays only.
+        '''
+        units: Unit = jax.tree_map(np.asarray, units)
+        n_units = units.unit_id.shape[0]
+        queue = units.action_queue
+
+        # action codes in queue order, the front action first
+        idx = (np.arange(queue.capacity) + queue.front[:, None]) % queue.capacity  # int[U, Q]
+        actions = np.stack([np.take_along_axis(x, idx, axis=-1) for x in queue.data], axis=-1)  # int[U, Q, 6]
+
+        lux_units = []
+        for i in range(n_units):
+            lux_unit = LuxUnit(
+                team=lux_teams[f'player_{int(units.team_id[i])}'],
+                unit_type=UnitType(int(units.unit_type[i])).to_lux(),
+                unit_id=f"unit_{int(units.unit_id[i])}",
+                env_cfg=lux_env_cfg,
+            )
+            lux_unit.pos = Position(units.pos.pos[i]).to_lux()
+            lux_unit.cargo = UnitCargo(units.cargo.stock[i]).to_lux()
+            lux_unit.power = int(units.power[i])
+            lux_unit.action_queue = [format_action_vec(code) for code in actions[i, :queue.count[i]]]
+            lux_units.append(lux_unit)
+        return lux_units
+
     def next_action(self) -> UnitAction:
+        # peek is always safe to call, so select against the empty action instead of branching.
         act = self.action_queue.peek()
-        act = jax.lax.cond(
-            self.action_queue.is_empty(),
-            lambda: UnitAction.do_nothing(),  # empty action
-            lambda: act,
-        )
+        nop = UnitAction.do_nothing()
+        empty = self.action_queue.is_empty()
+        act = jux.tree_util.tree_where(empty, nop, act)
         return act
 
     def repeat_action(self, success: bool) -> 'Unit':
@@ -124,54 +250,62 @@ class Unit(NamedTuple):
 
         From luxai_s2, we set the action's n value equal to repeat if we pop and push back
 
+        This function works on a single unit as well as on a batch of units
+        (e.g. Unit[2, U]), so it can be called directly on `State.units`
+        without vmap.
+
         Args:
             success (bool[2, U]): whether the action is executed successfully
         Returns:
             Unit: the unit with updated action queue
         '''
 
-        act = self.action_queue.peek()
-        not_empty = ~self.action_queue.is_empty()
-        n_minus_one = (act.n > 1) & success & not_empty
-        pop_only = (act.n <= 1) & ~act.repeat & success & not_empty
-        pop_and_push_back = (act.n <= 1) & act.repeat & success & not_empty
+        queue = self.action_queue
+        capacity = queue.capacity
+        slots = jnp.arange(capacity)  # int[Q]
 
-        data: UnitAction = jax.tree_map(
-            lambda queue, a: queue.at[self.action_queue.rear].set(a),
-            self.action_queue.data,
-            act._replace(n=jnp.where(pop_and_push_back, act.repeat, act.n)),
-        )
-        n = data.n.at[self.action_queue.front].add(-n_minus_one.astype(data.n.dtype))
-        data = data._replace(n=n)
+        def wrap(idx):
+            # same as idx % capacity for 0 <= idx <= capacity, but a compare and select instead of an integer division.
+            return jnp.where(idx == capacity, 0, idx)
 
-        front = jnp.where(
-            pop_only | pop_and_push_back,
-            (self.action_queue.front + 1) % self.action_queue.capacity,
-            self.action_queue.front,
+        act = jax.tree_map(
+            lambda x: jnp.take_along_axis(x, queue.front[..., None].astype(jnp.int32), axis=-1)[..., 0],
+            queue.data,
         )
-
-        rear = jnp.where(
+        not_empty = ~queue.is_empty()
+        n_minus_one = (act.n > 1) & success & not_empty
+        advance = (act.n <= 1) & success & not_empty  # pop, with or without push back
+        pop_and_push_back = advance & (act.repeat > 0)
+
+        # Decreasing n and pushing back never happen together, so both are a
+        # single write of the front action: with n - 1 into the front slot, or
+        # with n = repeat into the rear slot. Otherwise, the front action is
+        # written back to the front slot unchanged.
+        target = jnp.where(pop_and_push_back, queue.rear, queue.front)
+        new_act = act._replace(n=jnp.where(
             pop_and_push_back,
-            (self.action_queue.rear + 1) % self.action_queue.capacity,
-            self.action_queue.rear,
-        )
-
-        count = jnp.where(
-            pop_only,
-            self.action_queue.count - 1,
-            self.action_queue.count,
+            act.repeat,
+            act.n - n_minus_one.astype(act.n.dtype),
+        ))
+        data: UnitAction = jax.tree_map(
+            lambda x, a: jnp.where(slots == target[..., None], a[..., None], x),
+            queue.data,
+            new_act,
         )
 
-        action_queue = self.action_queue._replace(
+        # pop moves front forward, push back moves rear forward.
+        advance = advance.astype(queue.front.dtype)
+        push_back = pop_and_push_back.astype(queue.rear.dtype)
+        action_queue = ActionQueue(
             data=data,
-            front=front,
-            rear=rear,
-            count=count,
+            front=wrap(queue.front + advance),
+            rear=wrap(queue.rear + push_back),
+            count=queue.count - advance + push_back,
         )
         return self._replace(action_queue=action_queue)
 
     def is_heavy(self) -> Union[bool, Array]:
-        return self.unit_type == UnitType.HEAVY
+        return self.unit_type == _HEAVY
 
     def move_power_cost(self, rubble_at_target: int, unit_cfgs: Tuple[UnitConfig, UnitConfig]):
         move_cost = self.get_cfg("MOVE_COST", unit_cfgs)
@@ -184,75 +318,69 @@ class Unit(NamedTuple):
         amount: int,
         unit_cfgs: Tuple[UnitConfig, UnitConfig],
     ) -> Tuple['Unit', Union[int, Array]]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.add_power.
         amount = jnp.maximum(amount, 0)
+        return self._add_resource_unchecked(resource, amount, unit_cfgs)
+
+    def _add_resource_unchecked(
+        self,
+        resource: ResourceType,
+        amount: int,
+        unit_cfgs: Tuple[UnitConfig, UnitConfig],
+    ) -> Tuple['Unit', Union[int, Array]]:
+        # Same as add_resource, but the caller guarantees amount >= 0, so the clamp is skipped.
         cargo_space = self.get_cfg("CARGO_SPACE", unit_cfgs)
         battery_capacity = self.get_cfg("BATTERY_CAPACITY", unit_cfgs)
+        resources = self._stack_resources()  # int[..., 5]
+        capacities = jnp.stack([cargo_space] * 4 + [battery_capacity], axis=-1)  # int[..., 5]
 
-        def add_power(self, resource: ResourceType, amount: int):
-            transfer_amount = jnp.minimum(battery_capacity - self.power, amount)
-            new_unit = self._replace(power=self.power + transfer_amount)
-            return new_unit, transfer_amount
-
-        def add_others(self: Unit, resource: ResourceType, amount: int):
-            new_cargo, transfer_amount = self.cargo.add_resource(
-                resource=resource,
-                amount=amount,
-                cargo_space=cargo_space,
-            )
-            new_unit = self._replace(cargo=new_cargo)
-            return new_unit, transfer_amount
-
-        new_unit, transfer_amount = lax.cond(
-            resource == ResourceType.power,
-            add_power,
-            add_others,
-            *(self, resource, amount),
-        )
-        return new_unit, transfer_amount
+        # only the selected resource type has a non-zero delta
+        mask = jax.nn.one_hot(resource, len(ResourceType), dtype=resources.dtype)  # int[..., 5]
+        delta = jnp.minimum(capacities - resources, jnp.asarray(amount)[..., None]) * mask
+        return self._unstack_resources(resources + delta), delta.sum(axis=-1)
 
     def sub_resource(self, resource: ResourceType, amount: int) -> Tuple['Unit', Union[int, Array]]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.sub_resource.
-        def sub_power(self, resource: ResourceType, amount: int):
-            transfer_amount = jnp.minimum(self.power, amount)
-            new_unit = self._replace(power=self.power - transfer_amount)
-            return new_unit, transfer_amount
-
-        def sub_others(self: Unit, resource: ResourceType, amount: int):
-            new_cargo, transfer_amount = self.cargo.sub_resource(
-                resource=resource,
-                amount=amount,
-            )
-            new_unit = self._replace(cargo=new_cargo)
-            return new_unit, transfer_amount
-
-        new_unit, transfer_amount = lax.cond(
-            resource == ResourceType.power,
-            sub_power,
-            sub_others,
-            *(self, resource, amount),
+        amount = jnp.maximum(amount, 0)
+        resources = self._stack_resources()  # int[..., 5]
+
+        # only the selected resource type has a non-zero delta
+        mask = jax.nn.one_hot(resource, len(ResourceType), dtype=resources.dtype)  # int[..., 5]
+        delta = jnp.minimum(resources, jnp.asarray(amount)[..., None]) * mask
+        return self._unstack_resources(resources - delta), delta.sum(axis=-1)
+
+    def _stack_resources(self) -> Array:
+        '''Stack cargo and power into int[..., 5], indexed by ResourceType.'''
+        return jnp.concatenate([self.cargo.stock, jnp.asarray(self.power)[..., None]], axis=-1)
+
+    def _unstack_resources(self, resources: Array) -> 'Unit':
+        '''Inverse of _stack_resources.'''
+        return self._replace(
+            cargo=self.cargo._replace(stock=resources[..., :ResourceType.power]),
+            power=resources[..., ResourceType.power],
         )
-        return new_unit, transfer_amount
 
     def gain_power(self, unit_cfgs: Tuple[UnitConfig, UnitConfig]):
-        charge = self.get_cfg("CHARGE", unit_cfgs)
-        battery_capacity = self.get_cfg("BATTERY_CAPACITY", unit_cfgs)
-        new_power = self.power + charge
-        new_power = jnp.minimum(new_power, battery_capacity)
-        return self._replace(power=new_power)
+        # cast configs to power's dtype, so lax.add/lax.min can be used directly
+        # without going through jnp's dtype promotion.
+        power_dtype = Unit.__annotations__['power']
+        power = jnp.asarray(self.power, power_dtype)
+        charge = jnp.asarray(self.get_cfg("CHARGE", unit_cfgs), power_dtype)
+        battery_capacity = jnp.asarray(self.get_cfg("BATTERY_CAPACITY", unit_cfgs), power_dtype)
+        return self._replace(power=lax.min(lax.add(power, charge), battery_capacity))
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Unit):
             return False
-        eq = True
-        eq = eq & (self.unit_id == other.unit_id)
-        eq = eq & (self.unit_type == other.unit_type)
+
+        def scalar_fields(unit: Unit):
+            return jnp.stack([
+                jnp.asarray(unit.unit_type, jnp.int32),
+                jnp.asarray(unit.team_id, jnp.int32),
+                jnp.asarray(unit.unit_id, jnp.int32),
+                jnp.asarray(unit.power, jnp.int32),
+            ])
+
+        eq = jnp.all(scalar_fields(self) == scalar_fields(other), axis=0)
         eq = eq & (self.action_queue == other.action_queue)
-        eq = eq & (self.team_id == other.team_id)
-        eq = eq & (self.unit_id == other.unit_id)
         eq = eq & (self.pos == other.pos)
         eq = eq & (self.cargo == other.cargo)
-        eq = eq & (self.power == other.power)
         return eq
@@ -6,7 +6,7 @@ from luxai_s2.team import Team as LuxTeam
 
 from jux.factory import Factory, LuxFactory, LuxTeam
 from jux.map.position import Position
-from jux.unit import ResourceType, Unit, UnitCargo
+from jux.unit import ResourceType, UnitCargo
 
 
 class TestFactory(chex.TestCase):
@@ -47,8 +47,8 @@ class TestFactory(chex.TestCase):
         amount = 10
         factory: Factory = self.create_factory()
 
-        factory = factory._replace(cargo=factory.cargo._replace(stock=jnp.array([100, 0, 0, 0, 0])))
-        factory_sub_resource = self.variant(Unit.sub_resource, static_argnames=())
+        factory = factory._replace(cargo=factory.cargo._replace(stock=jnp.array([100, 0, 0, 0])))
+        factory_sub_resource = self.variant(Factory.sub_resource, static_argnames=())
         factory, transfer_amount = factory_sub_resource(factory, ResourceType.ice, amount)
         chex.assert_type(transfer_amount, int)
         assert transfer_amount == 10
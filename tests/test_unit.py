@@ -3,7 +3,9 @@ import jax
 from jax import numpy as jnp
 from luxai_s2.team import FactionTypes as LuxFactionTypes
 
+from jux.actions import ActionQueue, UnitAction
 from jux.config import EnvConfig
+from jux.map.position import Direction
 from jux.team import LuxTeam
 from jux.tree_util import batch_into_leaf
 from jux.unit import LuxUnit, LuxUnitType, Unit, UnitType
@@ -49,22 +51,27 @@ class TestUnit(chex.TestCase):
         ])
         res_type = jnp.array([1, 2, 3, 4, 4])
         amount = jnp.array([400, -10, 50, 20, 100])
-        new_units, transfer_amount = self.variant(jax.vmap(Unit.add_resource, in_axes=(0, 0, 0, None)))(
-            units,
-            res_type,
-            amount,
-            env_cfg.ROBOTS,
-        )
+        batched_add_resources = [
+            jax.vmap(Unit.add_resource, in_axes=(0, 0, 0, None)),
+            Unit.add_resource,  # batched units, without vmap
+        ]
+        for batched_add_resource in batched_add_resources:
+            new_units, transfer_amount = self.variant(batched_add_resource, static_argnames=())(
+                units,
+                res_type,
+                amount,
+                env_cfg.ROBOTS,
+            )
 
-        assert (transfer_amount == jnp.array([30, 0, 50, 20, 90])).all()
-        assert (new_units.cargo.stock == jnp.array([
-            [80, 100, 60, 50],
-            [80, 70, 60, 50],
-            [80, 70, 60, 100],
-            [0, 0, 0, 0],
-            [0, 0, 0, 0],
-        ])).all()
-        assert (new_units.power == jnp.array([50, 50, 50, 80, 150])).all()
+            assert (transfer_amount == jnp.array([30, 0, 50, 20, 90])).all()
+            assert (new_units.cargo.stock == jnp.array([
+                [80, 100, 60, 50],
+                [80, 70, 60, 50],
+                [80, 70, 60, 100],
+                [0, 0, 0, 0],
+                [0, 0, 0, 0],
+            ])).all()
+            assert (new_units.power == jnp.array([50, 50, 50, 80, 150])).all()
 
     @chex.variants(
         with_jit=True,
@@ -78,13 +85,141 @@ class TestUnit(chex.TestCase):
         amount = 10
         unit: Unit = self.create_unit(env_cfg)
 
-        unit = unit._replace(cargo=unit.cargo._replace(stock=jnp.array([100, 0, 0, 0, 0])))
+        unit = unit._replace(cargo=unit.cargo._replace(stock=jnp.array([100, 0, 0, 0])))
         unit_sub_resource = self.variant(Unit.sub_resource, static_argnames=())
         unit, transfer_amount = unit_sub_resource(unit, ResourceType.ice, amount)
         chex.assert_type(transfer_amount, int)
         assert transfer_amount == 10
         assert unit.cargo.ice == 90
 
+        # negative amount is clamped to 0, also for power
+        unit, transfer_amount = unit_sub_resource(unit._replace(power=50), ResourceType.power, -10)
+        assert transfer_amount == 0
+        assert unit.power == 50
+
+        # batched units, without vmap
+        unit: Unit = self.create_unit(env_cfg)
+        cargo = UnitCargo(stock=jnp.array([80, 70, 60, 50]))
+        units: Unit = batch_into_leaf([
+            unit._replace(cargo=cargo, power=60),
+            unit._replace(cargo=cargo, power=60),
+            unit._replace(cargo=cargo, power=60),
+            unit._replace(cargo=cargo, power=60),
+        ])
+        res_type = jnp.array([1, 2, 4, 4])
+        amount = jnp.array([400, -10, 20, 100])
+        new_units, transfer_amount = unit_sub_resource(units, res_type, amount)
+        assert (transfer_amount == jnp.array([70, 0, 20, 60])).all()
+        assert (new_units.cargo.stock == jnp.array([
+            [80, 0, 60, 50],
+            [80, 70, 60, 50],
+            [80, 70, 60, 50],
+            [80, 70, 60, 50],
+        ])).all()
+        assert (new_units.power == jnp.array([60, 60, 40, 0])).all()
+
+    @chex.variants(with_jit=True, without_jit=True, with_device=True, without_device=True)
+    def test_gain_power(self):
+        env_cfg = EnvConfig()
+        unit: Unit = self.create_unit(env_cfg)
+        unit_gain_power = self.variant(Unit.gain_power)
+
+        unit = unit_gain_power(unit._replace(power=60), env_cfg.ROBOTS)
+        assert unit.power == 60 + env_cfg.ROBOTS[UnitType.LIGHT].CHARGE
+
+        heavy = Unit.new(team_id=0, unit_type=UnitType.HEAVY, unit_id=2, env_cfg=env_cfg)._replace(power=60)
+        heavy = unit_gain_power(heavy, env_cfg.ROBOTS)
+        assert heavy.power == 60 + env_cfg.ROBOTS[UnitType.HEAVY].CHARGE
+
+        # power never goes above battery capacity
+        battery_capacity = env_cfg.ROBOTS[UnitType.LIGHT].BATTERY_CAPACITY
+        unit = unit_gain_power(unit._replace(power=battery_capacity), env_cfg.ROBOTS)
+        assert unit.power == battery_capacity
+
+    @chex.variants(with_jit=True, without_jit=True, with_device=True, without_device=True)
+    def test_repeat_action(self):
+        env_cfg = EnvConfig()
+        unit: Unit = self.create_unit(env_cfg)
+        unit_repeat_action = self.variant(Unit.repeat_action)
+
+        # n > 1, only decrease n
+        queue = unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=3))
+        new_unit = unit_repeat_action(unit._replace(action_queue=queue), True)
+        assert new_unit.action_queue.count == 1
+        assert new_unit.action_queue.peek() == UnitAction.move(Direction.UP, repeat=0, n=2)
+
+        # n == 1 and repeat == 0, pop
+        queue = unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=1))
+        new_unit = unit_repeat_action(unit._replace(action_queue=queue), True)
+        assert new_unit.action_queue.is_empty()
+
+        # n == 1 and repeat > 0, pop and push back with n = repeat
+        queue = unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=2, n=1))
+        queue = queue.push_back(UnitAction.dig(repeat=0, n=1))
+        new_unit = unit_repeat_action(unit._replace(action_queue=queue), True)
+        assert new_unit.action_queue.count == 2
+        act, queue = new_unit.action_queue.pop()
+        assert act == UnitAction.dig(repeat=0, n=1)
+        assert queue.peek() == UnitAction.move(Direction.UP, repeat=2, n=2)
+
+        # failed action, nothing changes
+        queue = unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=1))
+        new_unit = unit_repeat_action(unit._replace(action_queue=queue), False)
+        assert new_unit == unit._replace(action_queue=queue)
+
+        # empty queue, nothing changes
+        new_unit = unit_repeat_action(unit, True)
+        assert new_unit == unit
+
+        # batched units Unit[2, U], the same six cases as above
+        queues = [
+            unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=3)),
+            unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=1)),
+            unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=2, n=1)) \
+                             .push_back(UnitAction.dig(repeat=0, n=1)),
+            unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=2, n=1)),
+            unit.action_queue.push_back(UnitAction.move(Direction.UP, repeat=0, n=1)),
+            unit.action_queue,
+        ]
+        units: Unit = batch_into_leaf([unit._replace(action_queue=queue) for queue in queues])
+        units = jax.tree_map(lambda x: x.reshape((2, 3) + x.shape[1:]), units)
+        success = jnp.array([
+            [True, True, True],
+            [False, False, True],
+        ])
+        new_queue = unit_repeat_action(units, success).action_queue
+        assert (new_queue.front == jnp.array([[0, 1, 1], [0, 0, 0]])).all()
+        assert (new_queue.rear == jnp.array([[1, 1, 3], [1, 1, 0]])).all()
+        assert (new_queue.count == jnp.array([[1, 0, 2], [1, 1, 0]])).all()
+        front = new_queue.front[..., None].astype(jnp.int32)
+        front_n = jnp.take_along_axis(new_queue.data.n, front, axis=-1)[..., 0]
+        assert (front_n == jnp.array([[2, 0, 1], [1, 1, 0]])).all()
+        assert new_queue.data.n[0, 2, 2] == 2  # pushed back with n = repeat
+
+    @chex.variants(with_jit=True, without_jit=True, with_device=True, without_device=True)
+    def test_repeat_action_full_queue(self):
+        env_cfg = EnvConfig()
+        unit: Unit = self.create_unit(env_cfg)
+        unit_repeat_action = self.variant(Unit.repeat_action)
+
+        # a full queue from lux, whose front action is pushed back
+        queue = ActionQueue.from_lux(
+            [
+                UnitAction.move(Direction.UP, repeat=3, n=1).to_lux(),
+                UnitAction.dig(repeat=0, n=1).to_lux(),
+            ],
+            max_queue_size=2,
+        )
+        assert queue.is_full()
+        assert queue.rear == 0
+        new_unit = unit_repeat_action(unit._replace(action_queue=queue), True)
+        new_queue = new_unit.action_queue
+        assert new_queue.count == 2
+        assert (0 <= new_queue.rear) & (new_queue.rear < new_queue.capacity)
+        act, new_queue = new_queue.pop()
+        assert act == UnitAction.dig(repeat=0, n=1)
+        assert new_queue.peek() == UnitAction.move(Direction.UP, repeat=3, n=3)
+
     def test_to_from_lux(self):
         env_cfg = EnvConfig()
         lux_env_cfg = env_cfg.to_lux()
@@ -96,3 +231,32 @@ class TestUnit(chex.TestCase):
 
         jux_unit = Unit.from_lux(lux_unit, env_cfg)
         assert jux_unit == Unit.from_lux(jux_unit.to_lux(lux_teams, lux_env_cfg), env_cfg)
+
+    def test_batch_to_from_lux(self):
+        env_cfg = EnvConfig()
+        lux_env_cfg = env_cfg.to_lux()
+        lux_teams = {
+            'player_0': LuxTeam(0, LuxFactionTypes.AlphaStrike),
+            'player_1': LuxTeam(1, LuxFactionTypes.AlphaStrike),
+        }
+        lux_units = [
+            LuxUnit(team=lux_teams['player_0'], unit_type=LuxUnitType.HEAVY, unit_id="unit_1", env_cfg=lux_env_cfg),
+            LuxUnit(team=lux_teams['player_1'], unit_type=LuxUnitType.LIGHT, unit_id="unit_5", env_cfg=lux_env_cfg),
+        ]
+        lux_units[1].power = 42
+        lux_units[1].action_queue = [
+            UnitAction.move(Direction.UP, repeat=1, n=2).to_lux(),
+            UnitAction.dig(repeat=0, n=1).to_lux(),
+        ]
+
+        lux_units[0].action_queue = [UnitAction.dig(repeat=0, n=1).to_lux()] * env_cfg.UNIT_ACTION_QUEUE_SIZE
+
+        jux_units = Unit.batch_from_lux(lux_units, env_cfg)
+        assert (jux_units.action_queue.rear == jnp.array([0, 2])).all()
+        expected = batch_into_leaf([Unit.from_lux(u, env_cfg) for u in lux_units])
+        chex.assert_trees_all_equal(jux_units, expected)
+
+        new_lux_units = Unit.batch_to_lux(jux_units, lux_teams, lux_env_cfg)
+        assert len(new_lux_units) == len(lux_units)
+        for new_lux_unit, lux_unit in zip(new_lux_units, lux_units):
+            assert Unit.from_lux(new_lux_unit, env_cfg) == Unit.from_lux(lux_unit, env_cfg)